@@ -1,15 +1,25 @@
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import sys
 import time
 import argparse
-import json
 from dotenv import load_dotenv
 
 # --- Configuration ---
 STRAVA_API_BASE_URL = "https://www.strava.com/api/v3"
 TOKEN_URL = "https://www.strava.com/oauth/token"
 
+# Shared HTTP session so the token refresh and explore calls reuse one connection.
+# Rate-limited (429) and server error responses are retried with exponential backoff;
+# after the last retry the error response is returned so the HTTPError handling below applies.
+RETRY_POLICY = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                     respect_retry_after_header=True, raise_on_status=False)
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=16, max_retries=RETRY_POLICY))
+
 # --- Load Credentials ---
 load_dotenv() # Load variables from .env file
 
@@ -30,9 +40,9 @@ def refresh_access_token(client_id, client_secret, refresh_token):
     }
     print("Attempting to refresh access token...")
     try:
-        response = requests.post(TOKEN_URL, data=payload, timeout=15)
+        response = SESSION.post(TOKEN_URL, data=payload, timeout=15)
         response.raise_for_status()
-        token_data = response.json()
+        token_data = orjson.loads(response.content)
         new_access_token = token_data.get('access_token')
         expires_at = token_data.get('expires_at')
         if not new_access_token:
@@ -51,13 +61,12 @@ def refresh_access_token(client_id, client_secret, refresh_token):
         print(f"An unexpected error occurred during token refresh: {e}")
         return None
 
-def explore_segments(bounds, access_token, activity_type='riding', min_cat=None, max_cat=None):
+def explore_segments(bounds, activity_type='riding', min_cat=None, max_cat=None):
     """
-    Fetches segments within the specified bounds.
+    Fetches segments within the specified bounds, authenticated by the token set on SESSION.
 
     Args:
         bounds (str): Comma-separated string "sw_lat,sw_lng,ne_lat,ne_lng".
-        access_token (str): Valid Strava API access token.
         activity_type (str): 'riding' or 'running'. Defaults to 'riding'.
         min_cat (int, optional): Minimum climb category (0-5).
         max_cat (int, optional): Maximum climb category (0-5).
@@ -67,7 +76,6 @@ def explore_segments(bounds, access_token, activity_type='riding', min_cat=None,
               Returns an empty list if no segments are found.
     """
     explore_url = f"{STRAVA_API_BASE_URL}/segments/explore"
-    headers = {'Authorization': f'Bearer {access_token}'}
     params = {
         'bounds': bounds,
         'activity_type': activity_type
@@ -79,10 +87,10 @@ def explore_segments(bounds, access_token, activity_type='riding', min_cat=None,
 
     print(f"Exploring segments within bounds: {bounds} for activity: {activity_type}")
     try:
-        response = requests.get(explore_url, headers=headers, params=params, timeout=20) # Increased timeout for explore
+        response = SESSION.get(explore_url, params=params, timeout=20) # Increased timeout for explore
         response.raise_for_status() # Raise HTTPError for bad responses
 
-        data = response.json()
+        data = orjson.loads(response.content)
         segments = data.get('segments', []) # Segments are nested under 'segments' key
         return segments
 
@@ -103,7 +111,7 @@ def explore_segments(bounds, access_token, activity_type='riding', min_cat=None,
     except requests.exceptions.RequestException as e:
         print(f"Network Error exploring segments: {e}")
         return None
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Error decoding JSON response: {e}")
         print(f"Response Text: {response.text if 'response' in locals() else 'N/A'}")
         return None
@@ -144,11 +152,11 @@ if __name__ == "__main__":
     if not current_access_token:
         print("Failed to obtain a valid access token. Exiting.")
         sys.exit(1)
+    SESSION.headers['Authorization'] = f'Bearer {current_access_token}'
 
     # --- Explore Segments ---
     segments_found = explore_segments(
         bounds_str,
-        current_access_token,
         activity_type=args.activity,
         min_cat=args.min_cat,
         max_cat=args.max_cat
@@ -1,18 +1,47 @@
 import requests
-import pandas as pd
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import matplotlib
+matplotlib.use('Agg') # Plots are only saved to files; skip interactive backend setup (also in worker processes)
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import os
 import datetime
 import sys
 import configparser
+import argparse
+import csv
+import hashlib
+import json
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import StringIO # Needed for creating config in cloud environments
 
 # --- Configuration ---
 CONFIG_FILE = 'config.ini'
 MASTER_CSV_FILE = 'all_segments_log.csv'
+MASTER_CSV_COLUMNS = ['segment_id', 'segment_name', 'date', 'total_attempts_on_date', 'daily_attempts', 'athlete_count']
 PLOT_DIR = 'plots' # Directory to store plots
+LAST_STATE_FILE = 'last_state.json' # Latest date/total per segment, kept in step with the master CSV
+LAST_STATE_TAIL_SIZE = 64 * 1024 # Bytes at the end of the master CSV fingerprinted in the state file
+TOKEN_CACHE_FILE = '.strava_token.json' # Last access token, reused across runs until it expires
+TOKEN_EXPIRY_BUFFER = 300 # Seconds of remaining validity required to reuse a cached token
+
+# Single figure reused for every plot, created on first use (one per worker process)
+FIG = None
+AX = None
+
+# Shared HTTP session so all Strava API calls reuse the same keep-alive connection.
+# Rate-limited (429) and server error responses are retried with exponential backoff;
+# after the last retry the error response is returned so raise_for_status() reports it.
+RETRY_POLICY = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                     respect_retry_after_header=True, raise_on_status=False)
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=16, max_retries=RETRY_POLICY))
+MAX_FETCH_WORKERS = 8 # Segments fetched concurrently (must not exceed the pool size above)
+RATE_LIMIT_THRESHOLD = 0.9 # Fraction of a 15-minute Strava rate limit (overall or read) at which fetching pauses
+RATE_LIMIT_WINDOW = 15 * 60 # Strava's short-term limit resets every 15 minutes (on the quarter hour)
 
 def load_config():
     """
@@ -92,6 +121,63 @@ def load_config():
     return config_data
 
 
+def hash_refresh_token(refresh_token):
+    """Returns a SHA-256 hex digest identifying the refresh token without storing it."""
+    return hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+
+
+def load_cached_access_token(app_config):
+    """
+    Returns the access token stored in the token cache file if it was issued
+    for the configured client_id and refresh token and is still valid for more
+    than TOKEN_EXPIRY_BUFFER seconds, otherwise None.
+    """
+    if not os.path.exists(TOKEN_CACHE_FILE):
+        return None
+    try:
+        with open(TOKEN_CACHE_FILE, encoding='utf-8') as f:
+            cached_token = json.load(f)
+        if (cached_token['client_id'] != app_config['client_id']
+                or cached_token['refresh_token_sha256'] != hash_refresh_token(app_config['refresh_token'])):
+            print("DEBUG: Cached access token belongs to different credentials. Ignoring it.")
+            return None
+        if cached_token['expires_at'] - time.time() > TOKEN_EXPIRY_BUFFER:
+            print(f"Using cached Strava access token (expires {time.ctime(cached_token['expires_at'])}).")
+            return cached_token['access_token']
+        print("DEBUG: Cached access token expired or about to expire.")
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Warning: Could not read token cache '{TOKEN_CACHE_FILE}': {e}")
+    return None
+
+
+def discard_cached_access_token():
+    """Deletes the token cache file, e.g. after Strava rejected the cached token."""
+    try:
+        os.remove(TOKEN_CACHE_FILE)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Warning: Could not delete token cache '{TOKEN_CACHE_FILE}': {e}")
+
+
+def save_access_token(app_config, new_tokens):
+    """
+    Writes the new access token and its expiry to the token cache file, tagged
+    with the credentials it was issued for. The file holds a live bearer token,
+    so it is created readable by the owner only.
+    """
+    cached_token = {
+        'access_token': new_tokens['access_token'],
+        'expires_at': new_tokens['expires_at'],
+        'client_id': app_config['client_id'],
+        'refresh_token_sha256': hash_refresh_token(app_config['refresh_token'])
+    }
+    fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(TOKEN_CACHE_FILE, 0o600) # Also tighten a file left by an older run
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(cached_token, f)
+
+
 def refresh_access_token(app_config):
     """Refreshes the Strava access token using the refresh token."""
     print("Refreshing Strava access token...")
@@ -104,12 +190,16 @@ def refresh_access_token(app_config):
         'f': 'json'
     }
     try:
-        response = requests.post(auth_url, data=payload, timeout=30)
+        response = SESSION.post(auth_url, data=payload, timeout=30)
         response.raise_for_status()
-        new_tokens = response.json()
+        new_tokens = orjson.loads(response.content)
         print("Access token refreshed successfully.")
+        try:
+            save_access_token(app_config, new_tokens)
+        except (OSError, KeyError) as e:
+            print(f"Warning: Could not write token cache '{TOKEN_CACHE_FILE}': {e}")
         return new_tokens['access_token']
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         response_status = response.status_code if 'response' in locals() and response else 'N/A'
         response_text = response.text if 'response' in locals() and response else 'N/A'
         print(f"Error refreshing Strava token: {e}")
@@ -119,20 +209,63 @@ def refresh_access_token(app_config):
         sys.exit(1)
 
 
-def get_segment_data(segment_id, access_token):
+def wait_for_rate_limit(response):
+    """
+    Checks Strava's rate limit headers, each a "15min,daily" pair: the overall
+    X-RateLimit-Usage / X-RateLimit-Limit and, when present, the read-only
+    X-ReadRateLimit-Usage / X-ReadRateLimit-Limit (reads have their own, lower
+    caps, e.g. 100 per 15 minutes and 1000 per day). Throttles on whichever
+    limit is closest to its cap: if that 15-minute limit is nearly used up,
+    sleeps until the next window. Only warns about the daily limits, since
+    waiting for that reset isn't practical.
+    """
+    limits = []
+    for label, usage_name, limit_name in (('overall', 'X-RateLimit-Usage', 'X-RateLimit-Limit'),
+                                          ('read', 'X-ReadRateLimit-Usage', 'X-ReadRateLimit-Limit')):
+        usage_header = response.headers.get(usage_name)
+        limit_header = response.headers.get(limit_name)
+        if not usage_header or not limit_header:
+            continue
+        try:
+            short_usage, daily_usage = (int(value) for value in usage_header.split(',')[:2])
+            short_limit, daily_limit = (int(value) for value in limit_header.split(',')[:2])
+        except ValueError:
+            print(f"Warning: Could not parse {label} rate limit headers (usage={usage_header}, limit={limit_header}).")
+            continue
+        limits.append((label, short_usage, short_limit, daily_usage, daily_limit))
+    if not limits:
+        return
+
+    # The limit closest to its cap (by fraction used) is the one that matters
+    label, _, _, daily_usage, daily_limit = max(limits, key=lambda limit: limit[3] / limit[4] if limit[4] else 0)
+    if daily_limit and daily_usage >= RATE_LIMIT_THRESHOLD * daily_limit:
+        print(f"Warning: Daily Strava {label} rate limit nearly reached ({daily_usage}/{daily_limit}).")
+    label, short_usage, short_limit, _, _ = max(limits, key=lambda limit: limit[1] / limit[2] if limit[2] else 0)
+    if short_limit and short_usage >= RATE_LIMIT_THRESHOLD * short_limit:
+        wait_seconds = RATE_LIMIT_WINDOW - time.time() % RATE_LIMIT_WINDOW
+        print(f"{label.capitalize()} rate limit nearly reached ({short_usage}/{short_limit} in 15 min). Waiting {wait_seconds:.0f} seconds for the next window...")
+        time.sleep(wait_seconds)
+
+
+def get_segment_data(segment_id):
     """
     Fetches segment ID, name, total effort count, and total athlete count
-    from Strava API.
+    from Strava API, authenticated by the token set on SESSION.
+    Returns None on error, except when Strava rejects the access token (401):
+    the HTTPError is then re-raised so the caller can refresh the token.
+    Note: this has to be one request per segment. Strava has no batch segment
+    endpoint, and the summaries returned by segments/explore (see segments.py)
+    don't include effort_count or athlete_count.
     """
     print(f"Fetching data for segment ID: {segment_id}...")
     api_url = f"https://www.strava.com/api/v3/segments/{segment_id}"
-    headers = {'Authorization': f'Bearer {access_token}'}
     try:
-        # Add a small delay to be polite to the API
-        time.sleep(0.5)
-        response = requests.get(api_url, headers=headers, timeout=30)
+        response = SESSION.get(api_url, timeout=30)
         response.raise_for_status()
-        data = response.json()
+        # Only pace successful calls; an error response (e.g. a 429 after the retries
+        # ran out) is already reported and gains nothing from waiting
+        wait_for_rate_limit(response)
+        data = orjson.loads(response.content)
         segment_name = data.get('name', f"Unknown Segment {segment_id}")
         effort_count = data.get('effort_count', 0) # Total attempts
         athlete_count = data.get('athlete_count', 0) # Total unique athletes
@@ -143,30 +276,205 @@ def get_segment_data(segment_id, access_token):
             'effort_count': effort_count,
             'athlete_count': athlete_count
         }
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         response_status = response.status_code if 'response' in locals() and response else 'N/A'
         response_text = response.text if 'response' in locals() and response else 'N/A'
         print(f"Error fetching data for segment {segment_id}: {e}")
         print(f"  Response status: {response_status}")
         print(f"  Response text (partial): {response_text[:500]}")
+        if isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code == 401:
+            raise
         return None # Return None on error for this segment
 
 
-def update_master_log(segment_data):
+def fetch_segment(segment_id):
+    """
+    Worker for the concurrent fetch loop: fetches one segment, timing the call
+    and catching unexpected errors so one bad segment doesn't stop the others.
+    Returns (segment_data, unauthorized): the segment data dictionary, or None
+    on failure, and whether Strava rejected the access token (401).
+    """
+    segment_start_time = time.time()
+    print(f"\nProcessing Segment ID: {segment_id}")
+    segment_data = None
+    unauthorized = False
+    try:
+        segment_data = get_segment_data(segment_id)
+    except requests.exceptions.HTTPError: # Only re-raised for a rejected token (401)
+        unauthorized = True
+    except Exception as e:
+        print(f"!! UNEXPECTED ERROR fetching data for segment {segment_id}: {e}")
+    segment_end_time = time.time()
+    print(f"Finished fetching for {segment_id} (took {segment_end_time - segment_start_time:.2f} seconds)")
+    return segment_data, unauthorized
+
+
+def fetch_segments(segment_ids):
+    """
+    Fetches the given segments concurrently (see fetch_segment) and returns
+    their (segment_data, unauthorized) results in the same order.
+    """
+    with ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(segment_ids))) as executor:
+        return list(executor.map(fetch_segment, segment_ids))
+
+
+def hash_log_tail(csv_size):
+    """
+    Returns a SHA-256 hex digest of the last LAST_STATE_TAIL_SIZE bytes of the
+    master CSV (csv_size bytes long), which is where each run appends its rows.
+    """
+    with open(MASTER_CSV_FILE, 'rb') as f:
+        f.seek(max(csv_size - LAST_STATE_TAIL_SIZE, 0))
+        return hashlib.sha256(f.read(LAST_STATE_TAIL_SIZE)).hexdigest()
+
+
+def load_last_state(csv_size):
     """
-    Updates the master CSV log file (all_segments_log.csv) with daily data.
-    Calculates attempts since the last run for this segment (daily attempts).
-    Sets daily_attempts to 0 for the very first entry of a segment.
-    Appends a new data row in the specified format:
-    segment_id,segment_name,date,total_attempts_on_date,daily_attempts,athlete_count
+    Loads the per-segment lookup saved in LAST_STATE_FILE by the previous run.
+    The state is only trusted if it was saved against a master CSV of exactly
+    csv_size bytes whose tail still hashes the same, so an edit that keeps the
+    size but changes recent rows is caught (edits further back than the tail
+    aren't); otherwise (or if it can't be read) returns None.
+    """
+    if not os.path.exists(LAST_STATE_FILE):
+        return None
+    try:
+        with open(LAST_STATE_FILE, encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('csv_size') != csv_size or state.get('csv_tail_sha256') != hash_log_tail(csv_size):
+            print(f"DEBUG: State file '{LAST_STATE_FILE}' is out of date with '{MASTER_CSV_FILE}'. Rebuilding from CSV.")
+            return None
+        last_lookup = {int(segment_id): (entry['last_date'], entry['last_total'])
+                       for segment_id, entry in state['segments'].items()}
+        print(f"DEBUG: Loaded last entries for {len(last_lookup)} segment(s) from '{LAST_STATE_FILE}'.")
+        return last_lookup
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Warning: Could not read state file '{LAST_STATE_FILE}': {e}. Rebuilding from CSV.")
+        return None
+
+
+def save_last_state(last_lookup):
+    """
+    Atomically writes the per-segment lookup to LAST_STATE_FILE, tagged with the
+    current size and tail hash of the master CSV so a later run can tell if it
+    is still valid.
+    """
+    temp_file = f"{LAST_STATE_FILE}.tmp"
+    try:
+        csv_size = os.path.getsize(MASTER_CSV_FILE)
+        state = {
+            'csv_size': csv_size,
+            'csv_tail_sha256': hash_log_tail(csv_size),
+            'segments': {str(segment_id): {'last_date': last_date, 'last_total': last_total}
+                         for segment_id, (last_date, last_total) in last_lookup.items()}
+        }
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(temp_file, LAST_STATE_FILE)
+        print(f"DEBUG: Saved last entries for {len(last_lookup)} segment(s) to '{LAST_STATE_FILE}'.")
+    except OSError as e:
+        print(f"Warning: Could not write state file '{LAST_STATE_FILE}': {e}")
+
+
+def read_lines_backwards(file_path, chunk_size=64 * 1024):
+    """
+    Yields the lines of a text file from last to first, reading it in chunks
+    from the end so only the part that is actually consumed gets read.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b''
+        while position > 0:
+            read_size = min(chunk_size, position)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + remainder).split(b'\n')
+            remainder = lines.pop(0) # Possibly incomplete, completed by the next chunk
+            for line in reversed(lines):
+                yield line.decode('utf-8').rstrip('\r')
+        yield remainder.decode('utf-8').rstrip('\r')
+
+
+def load_last_entries(segment_ids, csv_size):
+    """
+    Returns a dictionary mapping segment IDs to (last_date_str,
+    last_total_attempts) for their most recent entry in the master CSV log.
+    last_total_attempts is None if that entry has no usable total.
+    csv_size is the current size of the log in bytes (0 if it doesn't exist).
+    Uses the state file when it matches the log and covers all segment_ids,
+    otherwise scans the CSV backwards, stopping once every segment is found.
+    Returns None if the log is missing, empty or has no header (it will be
+    created). Any other error reading the log is raised, so the caller can
+    leave the existing log alone instead of overwriting it.
+    """
+    if csv_size == 0:
+        print(f"DEBUG: Master log file '{MASTER_CSV_FILE}' not found or empty. Creating.")
+        return None
+
+    wanted_ids = {int(segment_id) for segment_id in segment_ids if str(segment_id).isdigit()}
+    last_lookup = load_last_state(csv_size)
+    if last_lookup is not None:
+        if wanted_ids.issubset(last_lookup):
+            return last_lookup
+        print(f"DEBUG: State file '{LAST_STATE_FILE}' is missing some segments. Rebuilding from CSV.")
+
+    print(f"DEBUG: Scanning existing log file backwards: {MASTER_CSV_FILE}")
+    with open(MASTER_CSV_FILE, newline='', encoding='utf-8') as f:
+        header = next(csv.reader(f), None)
+    if not header:
+        print(f"DEBUG: Log file '{MASTER_CSV_FILE}' was found but appears empty.")
+        return None
+    try:
+        id_col = header.index('segment_id')
+        date_col = header.index('date')
+        total_col = header.index('total_attempts_on_date')
+    except ValueError as e:
+        print(f"Warning: Missing expected column ({e}) reading '{MASTER_CSV_FILE}'. Header might be wrong. Treating all segments as new.")
+        return {}
+
+    # The log is appended in date order, so the first row seen per segment is its latest
+    last_lookup = {}
+    for line in read_lines_backwards(MASTER_CSV_FILE):
+        if not line:
+            continue
+        row = next(csv.reader([line]))
+        if row == header or len(row) <= max(id_col, date_col, total_col):
+            continue
+        try:
+            segment_id_int = int(row[id_col])
+        except ValueError:
+            continue
+        if segment_id_int in last_lookup:
+            continue
+        try:
+            last_total = int(row[total_col])
+        except ValueError:
+            print(f"Warning: Could not convert last 'total_attempts_on_date' ({row[total_col]}) to int for segment {segment_id_int}.")
+            last_total = None
+        last_lookup[segment_id_int] = (row[date_col], last_total)
+        if wanted_ids.issubset(last_lookup):
+            break
+    print(f"DEBUG: Found previous entries for {len(last_lookup)} segment(s).")
+    return last_lookup
+
+
+def update_master_log(segment_data, last_lookup, today_str):
+    """
+    Builds the daily log row for one segment from the pre-computed history lookup
+    (see load_last_entries). Calculates attempts since the last run for this
+    segment (daily attempts), setting them to 0 for the very first entry.
+    Records the new entry in last_lookup, so it stays current for the state file.
+    today_str is the run's date ('%Y-%m-%d'), shared by all rows of the run.
+    Returns the data row as a tuple in MASTER_CSV_COLUMNS order:
+    (segment_id, segment_name, date, total_attempts_on_date, daily_attempts, athlete_count)
+    or None if the segment data is invalid.
     """
-    today = datetime.date.today()
-    today_str = today.strftime('%Y-%m-%d')
     try:
         segment_id_int = int(segment_data['id'])
     except (ValueError, TypeError):
         print(f"ERROR: Invalid segment ID format received: {segment_data.get('id')}. Skipping update.")
-        return
+        return None
 
     segment_name = segment_data['name']
     current_total_attempts = int(segment_data.get('effort_count', 0) or 0)
@@ -174,75 +482,18 @@ def update_master_log(segment_data):
 
     last_total_attempts = 0
     last_date_str = "N/A"
-    is_first_entry_for_segment = True # Assume it's the first entry initially
-    df = None
-
-    header = "segment_id,segment_name,date,total_attempts_on_date,daily_attempts,athlete_count\n"
-    file_exists = os.path.exists(MASTER_CSV_FILE)
-    file_is_empty = not file_exists or os.path.getsize(MASTER_CSV_FILE) == 0
-
-    if not file_is_empty:
-        print(f"DEBUG: Reading existing log file: {MASTER_CSV_FILE}")
-        try:
-            df = pd.read_csv(MASTER_CSV_FILE, parse_dates=['date'], dtype={'segment_id': 'Int64'})
-
-            if not df.empty:
-                # Filter for the current segment
-                segment_df = df[df['segment_id'].notna() & (df['segment_id'] == segment_id_int)].sort_values(by='date')
-
-                if not segment_df.empty:
-                    # *** If we find previous entries, it's NOT the first entry ***
-                    is_first_entry_for_segment = False
-                    print(f"DEBUG: Found previous entries for segment {segment_id_int}.")
-
-                    last_entry = segment_df.iloc[-1]
-                    last_date_str = last_entry['date'].strftime('%Y-%m-%d')
-                    # print(f"DEBUG: last_entry data: {last_entry.to_dict()}") # Uncomment for deep debugging
-
-                    if 'total_attempts_on_date' in last_entry and pd.notna(last_entry['total_attempts_on_date']):
-                        try:
-                            last_total_attempts = int(last_entry['total_attempts_on_date'])
-                            print(f"DEBUG: Successfully read last_total_attempts: {last_total_attempts} from {last_date_str}")
-                        except (ValueError, TypeError):
-                            print(f"Warning: Could not convert last 'total_attempts_on_date' ({last_entry['total_attempts_on_date']}) to int for segment {segment_id_int}. Assuming 0 previous.")
-                            last_total_attempts = 0
-                    else:
-                        print(f"Warning: 'total_attempts_on_date' column missing or NaN in last entry for segment {segment_id_int} on {last_date_str}. Assuming 0 previous.")
-                        last_total_attempts = 0
-                else:
-                    # Segment ID not found, so it *is* the first entry for this segment
-                    print(f"DEBUG: Segment {segment_id_int} not found in existing data. Marking as first entry.")
-                    is_first_entry_for_segment = True
-                    last_total_attempts = 0
-            else:
-                file_is_empty = True
-                print(f"DEBUG: Log file '{MASTER_CSV_FILE}' was found but appears empty.")
-                is_first_entry_for_segment = True # Treat as first if file was empty
-                last_total_attempts = 0
-
-        except pd.errors.EmptyDataError:
-             file_is_empty = True
-             print(f"DEBUG: Log file '{MASTER_CSV_FILE}' is empty (pandas EmptyDataError).")
-             is_first_entry_for_segment = True
-             last_total_attempts = 0
-        except KeyError as e:
-             print(f"Warning: Key error (likely missing column: {e}) reading '{MASTER_CSV_FILE}'. Header might be wrong. Assuming 0 previous attempts.")
-             # We might have found the segment ID row but columns are bad.
-             # Hard to know if it *was* the first entry. Let's reset attempts but assume not first if ID was findable.
-             # Note: The check `if not segment_df.empty` above handles if the ID itself caused the KeyError during filtering.
-             # This KeyError handles cases where ID was found, but column access failed later.
-             # If segment_df was populated, is_first_entry_for_segment would be False already.
-             last_total_attempts = 0
-        except Exception as e:
-            print(f"Warning: Could not read/parse '{MASTER_CSV_FILE}'. History might be incomplete. Error: {e}")
-            file_is_empty = True # Treat as if file needs header/recreation
-            is_first_entry_for_segment = True # Assume first if we can't parse history
-            last_total_attempts = 0
 
+    entry = last_lookup.get(segment_id_int)
+    is_first_entry_for_segment = entry is None
+    if is_first_entry_for_segment:
+        print(f"DEBUG: Segment {segment_id_int} not found in existing data. Marking as first entry.")
     else:
-        print(f"DEBUG: Master log file '{MASTER_CSV_FILE}' not found or empty. Creating.")
-        is_first_entry_for_segment = True # Definitely the first entry if file doesn't exist
-        last_total_attempts = 0
+        last_date_str, last_total_attempts = entry
+        if last_total_attempts is None:
+            print(f"Warning: 'total_attempts_on_date' missing or invalid in last entry for segment {segment_id_int} on {last_date_str}. Assuming 0 previous.")
+            last_total_attempts = 0
+        else:
+            print(f"DEBUG: Successfully read last_total_attempts: {last_total_attempts} from {last_date_str}")
 
     # --- Calculate daily attempts based on whether it's the first entry ---
     if is_first_entry_for_segment:
@@ -265,44 +516,154 @@ def update_master_log(segment_data):
     print(f"    Attempts Today (Daily): {daily_attempts}") # This reflects the new logic
     print(f"    Total Unique Athletes:  {current_athlete_count}")
 
-    # Prepare the segment name for CSV
-    escaped_segment_name = segment_name.replace('"', '""')
-    quoted_segment_name = f'"{escaped_segment_name}"'
+    last_lookup[segment_id_int] = (today_str, current_total_attempts)
 
-    # Ensure integer types before creating the row string
-    daily_attempts_int = int(daily_attempts) # Ensure type
+    # Prepare new data row (quoting is left to csv.writer)
+    return (segment_id_int, segment_name, today_str, current_total_attempts, int(daily_attempts), current_athlete_count)
 
-    # Prepare new data row string
-    new_data_row = f"{segment_id_int},{quoted_segment_name},{today_str},{current_total_attempts},{daily_attempts_int},{current_athlete_count}\n"
 
-    # --- File Writing Logic (minor refinement for clarity) ---
+def write_master_log_rows(new_data_rows, needs_header):
+    """
+    Writes all of this run's data rows to the master CSV log in a single pass
+    with csv.writer, which also takes care of quoting segment names.
+    Creates the file with a header if needs_header is set, otherwise appends.
+    Returns True if the rows were written.
+    """
+    write_mode = 'w' if needs_header else 'a'
+    print(f"DEBUG: Setting write mode to '{write_mode}', needs_header={needs_header}")
     try:
-        # Determine write mode ('w' if new/empty, 'a' otherwise)
-        write_mode = 'a'
-        needs_header = False
-        if file_is_empty or not file_exists:
-            # If the file doesn't exist OR it exists but we determined it's empty (or couldn't parse)
-            write_mode = 'w'
-            needs_header = True
-            print(f"DEBUG: Setting write mode to 'w', needs_header=True")
-        else:
-             print(f"DEBUG: Setting write mode to 'a', needs_header=False")
-
         with open(MASTER_CSV_FILE, write_mode, newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, lineterminator='\n') # Match the log's existing line endings
             if needs_header:
-                f.write(header)
+                writer.writerow(MASTER_CSV_COLUMNS)
                 print(f"Wrote header to {MASTER_CSV_FILE}")
-            f.write(new_data_row)
-        print(f"Appended data for segment {segment_id_int} to '{MASTER_CSV_FILE}'")
+            writer.writerows(new_data_rows)
+        print(f"Appended {len(new_data_rows)} row(s) to '{MASTER_CSV_FILE}'")
+        return True
 
     except IOError as e:
         print(f"ERROR: Could not write to CSV file '{MASTER_CSV_FILE}': {e}")
+        return False
+
+
+def compact_master_log():
+    """
+    Recomputes daily_attempts for the whole master CSV in one vectorized pass
+    (difference to the segment's previous total, 0 for its first entry and for
+    drops; a blank total counts as 0, as in update_master_log, so a row after a
+    blank total gets its full total) and, if anything changed, atomically
+    rewrites the file. Rows without
+    a segment ID are dropped. The rewrite uses the same minimal quoting as
+    write_master_log_rows, so segment names are only quoted where needed.
+    Also refreshes the state file.
+    """
+    # pandas is imported only where it's used, so fetching and logging don't pay its import cost
+    import pandas as pd
+
+    if not os.path.exists(MASTER_CSV_FILE):
+        print(f"Compaction skipped: Master CSV file '{MASTER_CSV_FILE}' not found.")
+        return
+
+    print(f"Compacting '{MASTER_CSV_FILE}'...")
+    try:
+        # Read losslessly: names like "NA" or "None" stay strings, only empty numeric
+        # fields become missing, and IDs stay integers even if a row lacks one.
+        # ISO dates sort correctly as strings, so they don't need parsing here.
+        numeric_columns = ['segment_id', 'total_attempts_on_date', 'daily_attempts', 'athlete_count']
+        df = pd.read_csv(MASTER_CSV_FILE, keep_default_na=False,
+                         na_values={column: [''] for column in numeric_columns},
+                         dtype={**{column: 'Int64' for column in numeric_columns},
+                                'segment_name': str, 'date': str})
+
+        missing_id_rows = df['segment_id'].isna()
+        if missing_id_rows.any():
+            print(f"Warning: Dropping {missing_id_rows.sum()} row(s) without a segment_id.")
+            df = df[~missing_id_rows]
+
+        df_sorted = df.sort_values(by=['segment_id', 'date'], kind='stable')
+        # Blank totals count as 0, matching the daily run; only a segment's first row has no previous total
+        totals = df_sorted['total_attempts_on_date'].fillna(0)
+        previous_totals = totals.groupby(df_sorted['segment_id']).shift()
+        daily_attempts = (totals - previous_totals).clip(lower=0).fillna(0).astype('Int64')
+
+        if missing_id_rows.any() or not df['daily_attempts'].equals(daily_attempts.reindex(df.index)):
+            df = df.assign(daily_attempts=daily_attempts)
+            temp_file = f"{MASTER_CSV_FILE}.tmp"
+            df.to_csv(temp_file, index=False, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+            os.replace(temp_file, MASTER_CSV_FILE)
+            print(f"Rewrote {len(df)} row(s) in '{MASTER_CSV_FILE}'")
+        else:
+            print(f"'{MASTER_CSV_FILE}' is already up to date. Not rewriting it.")
+
+        last_rows = df_sorted.groupby('segment_id').tail(1)
+        save_last_state({int(segment_id): (last_date, int(last_total) if pd.notna(last_total) else None)
+                         for segment_id, last_date, last_total in zip(last_rows['segment_id'], last_rows['date'], last_rows['total_attempts_on_date'])})
+
+    except pd.errors.EmptyDataError:
+        print(f"Compaction skipped: Master CSV file '{MASTER_CSV_FILE}' is empty (pandas EmptyDataError).")
+    except KeyError as e:
+        print(f"Compaction skipped: Missing expected column ({e}) in '{MASTER_CSV_FILE}'. Check header/data.")
+    except Exception as e:
+        print(f"ERROR compacting '{MASTER_CSV_FILE}': {e}")
+
+
+def load_segment_history(segment_ids):
+    """
+    Reads the master CSV once for plotting and splits out the rows of the
+    given segments in a single groupby pass; segments in the history that
+    aren't being plotted get no frame of their own. Returns a dictionary
+    mapping segment ID to that segment's rows indexed and sorted by date,
+    or an empty dictionary if the log can't be read.
+    Note: the dictionary is the per-segment lookup, so callers should .get()
+    a segment's frame from it rather than masking the log by segment_id.
+    """
+    import pandas as pd
+
+    # Check if master CSV exists before trying to read
+    if not os.path.exists(MASTER_CSV_FILE):
+        print(f"Plotting skipped: Master CSV file '{MASTER_CSV_FILE}' not found.")
+        return {}
+
+    try:
+        # Read only the columns the plots use, with the log's fixed date format
+        # so pandas doesn't have to infer it
+        df_all = pd.read_csv(MASTER_CSV_FILE, usecols=['segment_id', 'date', 'daily_attempts'],
+                             parse_dates=['date'], date_format='%Y-%m-%d')
+        df_plotted = df_all[df_all['segment_id'].isin([int(segment_id) for segment_id in segment_ids])]
+        return {segment_id: df_segment.set_index('date').sort_index()
+                for segment_id, df_segment in df_plotted.groupby('segment_id', sort=False)}
+    except pd.errors.EmptyDataError:
+        print(f"Plotting skipped: Master CSV file '{MASTER_CSV_FILE}' is empty (pandas EmptyDataError).")
+    except (KeyError, ValueError) as e:
+        print(f"Plotting skipped: Missing expected column ({e}) in '{MASTER_CSV_FILE}'. Check header/data.")
+    except Exception as e:
+        print(f"ERROR reading '{MASTER_CSV_FILE}' for plotting: {e}")
+    return {}
+
+
+def get_plot_axes():
+    """
+    Returns the shared figure and axes, creating them on first use, cleared and
+    with the default subplot layout restored so no state from the previous
+    plot (e.g. its tight_layout adjustments) carries over.
+    """
+    global FIG, AX
+    if FIG is None:
+        FIG, AX = plt.subplots(figsize=(12, 6))
+    AX.clear()
+    FIG.subplots_adjust(**{param: plt.rcParams[f'figure.subplot.{param}']
+                           for param in ('left', 'right', 'bottom', 'top', 'wspace', 'hspace')})
+    return FIG, AX
 
-def generate_plot(segment_id, segment_name):
+
+def generate_plot(segment_id, segment_name, df_segment):
     """
     Generates a plot of *daily* attempts for a specific segment
-    reading data from the master CSV. Ensures the first point is zero.
+    from its rows of the master CSV. Ensures the first point is zero.
     """
+    import numpy as np
+    import pandas as pd
+
     plot_filename = f"segment_{segment_name}_plot.png"
     plot_filepath = os.path.join(PLOT_DIR, plot_filename)
     print(f"Generating plot '{plot_filepath}' for segment {segment_id}...")
@@ -310,18 +671,7 @@ def generate_plot(segment_id, segment_name):
     # Create plot directory if it doesn't exist
     os.makedirs(PLOT_DIR, exist_ok=True)
 
-    # Check if master CSV exists before trying to read
-    if not os.path.exists(MASTER_CSV_FILE):
-         print(f"Plotting skipped: Master CSV file '{MASTER_CSV_FILE}' not found.")
-         return
-
     try:
-        # Read master CSV, setting 'date' column as index
-        df_all = pd.read_csv(MASTER_CSV_FILE, parse_dates=['date'], index_col='date')
-
-        # Filter for the specific segment ID (convert segment_id to int for matching)
-        df_segment = df_all[df_all['segment_id'] == int(segment_id)].copy() # Use .copy() to avoid SettingWithCopyWarning
-
         # Check if DataFrame is empty or lacks the required 'daily_attempts' column
         if df_segment.empty or 'daily_attempts' not in df_segment.columns:
              print(f"Plotting skipped: No data or 'daily_attempts' column found for segment {segment_id} in '{MASTER_CSV_FILE}'. Check header/data.")
@@ -331,21 +681,20 @@ def generate_plot(segment_id, segment_name):
              return
 
         # Ensure data is sorted by date
-        df_segment.sort_index(inplace=True)
+        df_segment = df_segment.sort_index()
 
         # --- Add synthetic zero point for plotting daily attempts ---
         # Create a date point slightly before the first actual data point
         first_real_date = df_segment.index.min()
-        zero_point_date = first_real_date - pd.Timedelta(days=1) # One day before
-        # Create a DataFrame for the zero point using the 'daily_attempts' column
-        zero_point_df = pd.DataFrame({'daily_attempts': [0]}, index=[zero_point_date])
-        # Concatenate the zero point at the beginning using the 'daily_attempts' column
-        df_to_plot = pd.concat([zero_point_df, df_segment[['daily_attempts']]])
+        zero_point_date = (first_real_date - pd.Timedelta(days=1)).to_datetime64() # One day before
+        # Prepend the zero point directly to the plot arrays (no temporary DataFrame)
+        plot_dates = np.concatenate([[zero_point_date], df_segment.index.values])
+        plot_attempts = np.concatenate([[0], df_segment['daily_attempts'].values])
         # --- End synthetic zero point addition ---
 
-        # Proceed with plotting using df_to_plot and the 'daily_attempts' column
-        fig, ax = plt.subplots(figsize=(12, 6))
-        ax.plot(df_to_plot.index, df_to_plot['daily_attempts'], marker='o', linestyle='-')
+        # Proceed with plotting using the prepared 'daily_attempts' arrays
+        fig, ax = get_plot_axes()
+        ax.plot(plot_dates, plot_attempts, marker='o', linestyle='-')
 
         # Update plot title and labels for Daily Attempts
         ax.set_title(f'Daily Attempts on Segment: {segment_name} ({segment_id})')
@@ -357,22 +706,19 @@ def generate_plot(segment_id, segment_name):
         # Format x-axis dates
         ax.xaxis.set_major_locator(mdates.AutoDateLocator(minticks=4, maxticks=12))
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-        plt.xticks(rotation=30, ha='right')
+        plt.setp(ax.get_xticklabels(), rotation=30, ha='right')
 
-        plt.tight_layout()
-        plt.savefig(plot_filepath)
+        fig.tight_layout()
+        fig.savefig(plot_filepath)
         print(f"Plot saved to '{plot_filepath}'")
-        plt.close(fig) # Close the plot figure to free memory
 
-    except pd.errors.EmptyDataError:
-        print(f"Plotting skipped: Master CSV file '{MASTER_CSV_FILE}' is empty (pandas EmptyDataError).")
     except KeyError as e:
         print(f"Plotting skipped for segment {segment_id}: Missing expected column ({e}) in '{MASTER_CSV_FILE}'. Check header/data.")
     except Exception as e:
         print(f"ERROR generating plot for segment {segment_id}: {e}")
 
 
-def generate_weekly_plot(segment_id, segment_name):
+def generate_weekly_plot(segment_id, segment_name, df_segment):
     """
     Generates a plot of weekly accumulated attempts for a specific segment.
     """
@@ -382,19 +728,12 @@ def generate_weekly_plot(segment_id, segment_name):
 
     os.makedirs(PLOT_DIR, exist_ok=True)
 
-    if not os.path.exists(MASTER_CSV_FILE):
-        print(f"Weekly plotting skipped: Master CSV file '{MASTER_CSV_FILE}' not found.")
-        return
-
     try:
-        df_all = pd.read_csv(MASTER_CSV_FILE, parse_dates=['date'], index_col='date')
-        df_segment = df_all[df_all['segment_id'] == int(segment_id)].copy()
-
         if df_segment.empty or 'daily_attempts' not in df_segment.columns:
             print(f"Weekly plotting skipped: No data for segment {segment_id}.")
             return
 
-        df_segment.sort_index(inplace=True)
+        df_segment = df_segment.sort_index()
 
         # Resample to weekly frequency and sum daily attempts
         df_weekly = df_segment['daily_attempts'].resample('W').sum()
@@ -403,7 +742,7 @@ def generate_weekly_plot(segment_id, segment_name):
             print(f"Weekly plotting skipped: Not enough data for segment {segment_id}.")
             return
 
-        fig, ax = plt.subplots(figsize=(12, 6))
+        fig, ax = get_plot_axes()
         ax.plot(df_weekly.index, df_weekly.values, marker='o', linestyle='-')
 
         ax.set_title(f'Weekly Accumulated Attempts on Segment: {segment_name} ({segment_id})')
@@ -414,18 +753,17 @@ def generate_weekly_plot(segment_id, segment_name):
 
         ax.xaxis.set_major_locator(mdates.AutoDateLocator(minticks=4, maxticks=12))
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-        plt.xticks(rotation=30, ha='right')
+        plt.setp(ax.get_xticklabels(), rotation=30, ha='right')
 
-        plt.tight_layout()
-        plt.savefig(plot_filepath)
+        fig.tight_layout()
+        fig.savefig(plot_filepath)
         print(f"Weekly plot saved to '{plot_filepath}'")
-        plt.close(fig)
 
     except Exception as e:
         print(f"ERROR generating weekly plot for segment {segment_id}: {e}")
 
 
-def generate_monthly_plot(segment_id, segment_name):
+def generate_monthly_plot(segment_id, segment_name, df_segment):
     """
     Generates a plot of monthly accumulated attempts for a specific segment.
     """
@@ -435,19 +773,12 @@ def generate_monthly_plot(segment_id, segment_name):
 
     os.makedirs(PLOT_DIR, exist_ok=True)
 
-    if not os.path.exists(MASTER_CSV_FILE):
-        print(f"Monthly plotting skipped: Master CSV file '{MASTER_CSV_FILE}' not found.")
-        return
-
     try:
-        df_all = pd.read_csv(MASTER_CSV_FILE, parse_dates=['date'], index_col='date')
-        df_segment = df_all[df_all['segment_id'] == int(segment_id)].copy()
-
         if df_segment.empty or 'daily_attempts' not in df_segment.columns:
             print(f"Monthly plotting skipped: No data for segment {segment_id}.")
             return
 
-        df_segment.sort_index(inplace=True)
+        df_segment = df_segment.sort_index()
 
         # Resample to monthly frequency and sum daily attempts
         df_monthly = df_segment['daily_attempts'].resample('ME').sum()
@@ -456,7 +787,7 @@ def generate_monthly_plot(segment_id, segment_name):
             print(f"Monthly plotting skipped: Not enough data for segment {segment_id}.")
             return
 
-        fig, ax = plt.subplots(figsize=(12, 6))
+        fig, ax = get_plot_axes()
         ax.plot(df_monthly.index, df_monthly.values, marker='o', linestyle='-')
 
         ax.set_title(f'Monthly Accumulated Attempts on Segment: {segment_name} ({segment_id})')
@@ -467,19 +798,38 @@ def generate_monthly_plot(segment_id, segment_name):
 
         ax.xaxis.set_major_locator(mdates.MonthLocator())
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-        plt.xticks(rotation=30, ha='right')
+        plt.setp(ax.get_xticklabels(), rotation=30, ha='right')
 
-        plt.tight_layout()
-        plt.savefig(plot_filepath)
+        fig.tight_layout()
+        fig.savefig(plot_filepath)
         print(f"Monthly plot saved to '{plot_filepath}'")
-        plt.close(fig)
 
     except Exception as e:
         print(f"ERROR generating monthly plot for segment {segment_id}: {e}")
 
 
+def plot_segment(plot_job):
+    """
+    Process pool worker: generates the daily, weekly and monthly plots for one
+    segment from a (segment_id, segment_name, df_segment) tuple.
+    """
+    segment_id, segment_name, df_segment = plot_job
+    generate_plot(segment_id, segment_name, df_segment)
+    generate_weekly_plot(segment_id, segment_name, df_segment)
+    generate_monthly_plot(segment_id, segment_name, df_segment)
+
+
 # --- Main Execution Logic ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Log daily attempts on Strava segments and plot them.")
+    parser.add_argument("--compact", action="store_true",
+                        help="Recompute daily_attempts for the whole log, rewrite it and exit.")
+    args = parser.parse_args()
+
+    if args.compact:
+        compact_master_log()
+        sys.exit(0)
+
     start_time = datetime.datetime.now()
     print(f"--- Strava Segment Tracker Started: {start_time.strftime('%Y-%m-%d %H:%M:%S')} ---")
 
@@ -488,8 +838,13 @@ if __name__ == "__main__":
     segment_ids_to_process = app_config['segment_id_list']
     print(f"\nFound {len(segment_ids_to_process)} segment(s) to process: {', '.join(segment_ids_to_process)}")
 
-    # 2. Get Fresh Access Token
-    access_token = refresh_access_token(app_config)
+    # 2. Get Access Token (cached from a previous run if still valid)
+    access_token = load_cached_access_token(app_config)
+    token_is_cached = access_token is not None
+    if not token_is_cached:
+        access_token = refresh_access_token(app_config)
+    # Authenticate every later API call through the shared session
+    SESSION.headers['Authorization'] = f'Bearer {access_token}'
 
     # 3. Loop through each Segment ID to fetch current data
     processed_count = 0
@@ -497,40 +852,64 @@ if __name__ == "__main__":
     all_segment_data_current = [] # Store currently fetched data
 
     print("\n--- Fetching Current Segment Data ---")
-    for segment_id in segment_ids_to_process:
-        segment_start_time = time.time()
-        print(f"\nProcessing Segment ID: {segment_id}")
-        try:
-            segment_data = get_segment_data(segment_id, access_token)
-            if segment_data:
-                all_segment_data_current.append(segment_data)
-                processed_count += 1
-            else:
-                print(f"Skipping segment {segment_id} due to data fetch failure.")
-                error_count += 1
-
-        except Exception as e:
-            print(f"!! UNEXPECTED ERROR fetching data for segment {segment_id}: {e}")
+    # Fetch segments concurrently; results come back in the configured order
+    fetch_results = fetch_segments(segment_ids_to_process)
+
+    # A cached token can be revoked before it expires: drop it, refresh once and refetch
+    rejected_ids = [segment_id for segment_id, (_, unauthorized) in zip(segment_ids_to_process, fetch_results) if unauthorized]
+    if rejected_ids and token_is_cached:
+        print("\nCached access token was rejected (401). Discarding it and refreshing...")
+        discard_cached_access_token()
+        access_token = refresh_access_token(app_config)
+        SESSION.headers['Authorization'] = f'Bearer {access_token}'
+        refetched = dict(zip(rejected_ids, fetch_segments(rejected_ids)))
+        fetch_results = [refetched.get(segment_id, result) for segment_id, result in zip(segment_ids_to_process, fetch_results)]
+
+    for segment_id, (segment_data, _) in zip(segment_ids_to_process, fetch_results):
+        if segment_data:
+            all_segment_data_current.append(segment_data)
+            processed_count += 1
+        else:
+            print(f"Skipping segment {segment_id} due to data fetch failure.")
             error_count += 1
-            # Attempt to continue with the next segment
-        segment_end_time = time.time()
-        print(f"Finished fetching for {segment_id} (took {segment_end_time - segment_start_time:.2f} seconds)")
 
     # 4. Update Log File and Generate Plots (after fetching all data)
     print(f"\n--- Updating Log File: {MASTER_CSV_FILE} ---")
     if not all_segment_data_current:
         print("No segment data fetched successfully. Skipping log update and plotting.")
     else:
-        # Update the master log file sequentially for each fetched segment
-        for segment_data in all_segment_data_current:
-             update_master_log(segment_data) # This calculates daily diff based on file history
+        # Per-run invariants, computed once for all segments
+        today_str = datetime.date.today().strftime('%Y-%m-%d')
+        csv_size = os.path.getsize(MASTER_CSV_FILE) if os.path.exists(MASTER_CSV_FILE) else 0
+
+        # Read the log history once, then build every segment's row from it
+        try:
+            last_lookup = load_last_entries([segment_data['id'] for segment_data in all_segment_data_current], csv_size)
+        except Exception as e:
+            print(f"ERROR: Could not read/parse '{MASTER_CSV_FILE}': {e}. Skipping log update so the existing log isn't overwritten.")
+        else:
+            needs_header = last_lookup is None
+            if needs_header:
+                last_lookup = {}
+            new_data_rows = [update_master_log(segment_data, last_lookup, today_str) for segment_data in all_segment_data_current]
+            if write_master_log_rows([row for row in new_data_rows if row], needs_header):
+                save_last_state(last_lookup)
 
         print(f"\n--- Generating Plots (Output to '{PLOT_DIR}/') ---")
-        # Generate plots using the now updated master log file
+        # Parse the now updated master log file once and plot each segment from its rows
+        segment_history = load_segment_history([segment_data['id'] for segment_data in all_segment_data_current])
+        plot_jobs = []
         for segment_data in all_segment_data_current:
-            generate_plot(segment_data['id'], segment_data['name'])
-            generate_weekly_plot(segment_data['id'], segment_data['name'])
-            generate_monthly_plot(segment_data['id'], segment_data['name'])
+            df_segment = segment_history.get(int(segment_data['id']))
+            if df_segment is None:
+                print(f"Plotting skipped: No data found for segment {segment_data['id']} in '{MASTER_CSV_FILE}'.")
+                continue
+            plot_jobs.append((segment_data['id'], segment_data['name'], df_segment))
+
+        # Rendering is CPU-bound, so spread the segments over worker processes
+        if plot_jobs:
+            with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(plot_jobs))) as executor:
+                list(executor.map(plot_segment, plot_jobs))
 
 
     # --- Summary ---